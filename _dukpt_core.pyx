@@ -0,0 +1,124 @@
+# cython: language_level=3
+"""C implementation of the DUKPT key derivation loop
+
+Used by dukpt.DUKPT.derive_key when built, using OpenSSL's libcrypto
+for the single DES steps. Key schedules and key buffers are wiped with
+OPENSSL_cleanse once they are no longer needed.
+"""
+from libc.stdint cimport uint8_t, uint64_t
+
+cdef extern from "openssl/crypto.h":
+    void OPENSSL_cleanse(void *ptr, size_t len) nogil
+
+cdef extern from "openssl/des.h":
+    ctypedef unsigned char DES_cblock[8]
+    ctypedef struct DES_key_schedule:
+        pass
+    enum: DES_ENCRYPT
+    void DES_set_key_unchecked(DES_cblock *key, DES_key_schedule *schedule) nogil
+    void DES_ecb_encrypt(DES_cblock *input, DES_cblock *output,
+                         DES_key_schedule *ks, int enc) nogil
+
+cdef uint64_t C_MASK   = 0xc0c0c0c000000000
+cdef uint64_t CTR_MASK = 0x1FFFFF
+
+cdef inline uint64_t _load(const uint8_t *p) noexcept nogil:
+    cdef uint64_t v = 0
+    cdef int i
+    for i in range(8):
+        v = (v << 8) | p[i]
+    return v
+
+cdef inline void _store(uint64_t v, uint8_t *p) noexcept nogil:
+    cdef int i
+    for i in range(7, -1, -1):
+        p[i] = v & 0xFF
+        v >>= 8
+
+cdef inline uint64_t _des(uint64_t key, uint64_t block) noexcept nogil:
+    cdef uint8_t k[8]
+    cdef uint8_t b[8]
+    cdef DES_key_schedule ks
+    _store(key, k)
+    _store(block, b)
+    DES_set_key_unchecked(<DES_cblock *> k, &ks)
+    DES_ecb_encrypt(<DES_cblock *> b, <DES_cblock *> b, &ks, DES_ENCRYPT)
+    block = _load(b)
+    OPENSSL_cleanse(k, sizeof(k))
+    OPENSSL_cleanse(b, sizeof(b))
+    OPENSSL_cleanse(&ks, sizeof(ks))
+    return block
+
+cdef void _derive(const uint8_t *ipek, const uint8_t *ksn, uint8_t *out) noexcept nogil:
+    cdef uint64_t left, right, r8, r3, sr, r8a, r8b
+
+    left  = _load(ipek)
+    right = _load(ipek + 8)
+    r8    = _load(ksn + 2)
+    r3    = r8 & CTR_MASK
+    r8   &= ~CTR_MASK
+    sr    = 0x100000
+
+    while sr:
+        if sr & r3:
+            r8   |= sr
+            r8a   = _des(left, r8 ^ right) ^ right
+            left ^= C_MASK
+            right ^= C_MASK
+            r8b   = _des(left, r8 ^ right) ^ right
+            left  = r8b
+            right = r8a
+        sr >>= 1
+
+    _store(left, out)
+    _store(right, out + 8)
+
+cpdef bytes derive_key(const uint8_t[::1] ipek, const uint8_t[::1] ksn):
+    """Derive a unique key given the ipek and ksn
+
+    Keyword arguments:
+    ipek (raw) -- Initial Pin Encryption Key (16 bytes)
+    ksn (raw)  -- Key Serial Number (10 bytes)
+
+    Return:
+    key in bytes
+    """
+    cdef uint8_t out[16]
+    cdef bytes key
+
+    if ipek.shape[0] != 16 or ksn.shape[0] != 10:
+        raise ValueError("ipek must be 16 bytes and ksn 10 bytes")
+
+    with nogil:
+        _derive(&ipek[0], &ksn[0], out)
+    key = out[:16]
+    OPENSSL_cleanse(out, sizeof(out))
+    return key
+
+cpdef bytes derive_keys(const uint8_t[::1] ipeks, const uint8_t[::1] ksns):
+    """Derive the keys for a batch of ipek and ksn pairs
+
+    Keyword arguments:
+    ipeks (raw) -- Initial Pin Encryption Keys, 16 bytes each, back to back
+    ksns (raw)  -- Key Serial Numbers, 10 bytes each, back to back
+
+    Return:
+    keys in bytes, 16 bytes each, back to back
+    """
+    cdef Py_ssize_t i, n = ksns.shape[0] // 10
+    cdef bytearray out
+    cdef bytes keys
+    cdef uint8_t[::1] view
+
+    if ksns.shape[0] != n * 10 or ipeks.shape[0] != n * 16:
+        raise ValueError("ipeks must be 16 bytes and ksns 10 bytes per key")
+
+    out  = bytearray(n * 16)
+    view = out
+    with nogil:
+        for i in range(n):
+            _derive(&ipeks[i * 16], &ksns[i * 10], &view[i * 16])
+    keys = bytes(out)
+    if n:
+        OPENSSL_cleanse(&view[0], n * 16)
+    return keys
@@ -1,19 +1,40 @@
-from bitstring import BitArray
 from Crypto.Cipher import DES, DES3
 from Crypto.Random import get_random_bytes
 
+try:
+    from _dukpt_core import derive_key as _derive_key, derive_keys as _derive_keys
+except ImportError:
+    _derive_key = _derive_keys = None
+
+_PIN_MASK      = 0x00000000000000FF00000000000000FF
+_MAC_REQ_MASK  = 0x000000000000FF00000000000000FF00
+_MAC_RESP_MASK = 0x00000000FF00000000000000FF000000
+_MAC_DATA_REQ  = 0x0000000000FF00000000000000FF0000
+_MAC_DATA_RESP = 0x000000FF00000000000000FF00000000
+_C_MASK8       = 0xc0c0c0c000000000
+_C_MASK24      = 0xc0c0c0c000000000c0c0c0c000000000c0c0c0c000000000
+_CTR_MASK      = 0x1FFFFF
+
+def _des_cipher(key, cache=None):
+    """Return a single DES ECB cipher for an 8 byte key
+
+    Keyword arguments:
+    key (raw)    -- DES key (8 bytes)
+    cache (dict) -- Optional, caller scoped cache of ciphers by key
+    """
+    if cache is None:
+        return DES.new(key, DES.MODE_ECB)
+    cipher = cache.get(key)
+    if cipher is None:
+        cipher = cache[key] = DES.new(key, DES.MODE_ECB)
+    return cipher
+
 class InvalidDUKPTArguments(Exception):
     pass
 
 class DUKPT:
     """Base DUKPT class with common functions of both client and server"""
-    _pin_mask      = BitArray(hex="0x00000000000000FF00000000000000FF")
-    _mac_req_mask  = BitArray(hex="0x000000000000FF00000000000000FF00")
-    _mac_resp_mask = BitArray(hex="0x00000000FF00000000000000FF000000")
-    _mac_data_req  = BitArray(hex="0x0000000000FF00000000000000FF0000")
-    _mac_data_resp = BitArray(hex="0x000000FF00000000000000FF00000000")
     _ipek          = None
-    _tdes_key      = None
     _cur_key       = None
     _ksn           = None
     BDK_LEN        = 16
@@ -22,121 +43,139 @@ class DUKPT:
     def __init__(self, bdk=None, ksn=None, ipek=None):
         """Initialization
         Keyword arguments:
-        bdk (raw or BitArray)  -- Base Derivation Key (16 bytes)
-        ksn (raw or BitArray)  -- Key Serial Number (10 bytes)
-        ipek (raw or BitArray) -- Initial Pin Encryption Key (16 bytes)
+        bdk (raw)  -- Base Derivation Key (16 bytes)
+        ksn (raw)  -- Key Serial Number (10 bytes)
+        ipek (raw) -- Initial Pin Encryption Key (16 bytes)
         """
         if ipek:
-            if isinstance(ipek, BitArray):
-                self._ipek = ipek
-            else:
-                self._ipek = BitArray(bytes=ipek)
-            if isinstance(ksn, BitArray):
-                self._ksn = ksn
-            else:
-                self._ksn  = BitArray(bytes=ksn)
+            self._ipek = bytes(ipek)
+            self._ksn  = bytes(ksn)
         else:
             if not bdk:
                 raise InvalidDUKPTArguments("Must have either ipek or bdk")
             if len(bdk) != self.BDK_LEN:
                 raise InvalidDUKPTArguments("BDK must have a length of %d" % self.BDK_LEN)
-            self._bdk = BitArray(bytes=bdk)
+            self._bdk = bytes(bdk)
         
-    def derive_key(self, ipek, ksn):
+    def derive_key(self, ipek, ksn, cache=None):
         """Derive a unique key given the ipek and ksn
 
         Keyword arguments:
-        ipek (BitArray) -- Initial Pin Encryption Key
-        ksn (BitArray)  -- Key Serial Number
+        ipek (raw)    -- Initial Pin Encryption Key
+        ksn (raw)     -- Key Serial Number
+        cache (dict)  -- Optional, shared between calls to reuse the
+                         intermediate keys and DES ciphers of common
+                         counter prefixes
+
+        Return:
+        key in bytes
         """
-        c_mask       = BitArray(hex='0xc0c0c0c000000000c0c0c0c000000000')
-        ksn_offset   = 2
-        ctr_offset   = -3
-        right_offset = 8
-
-        # Registers taken from documentation
-        curkey = ipek
-        ksnr   = BitArray(bytes=ksn.bytes[ksn_offset:])
+        if _derive_key is not None:
+            self._cur_key = _derive_key(ipek, ksn)
+            return self._cur_key
+
+        ksn_offset = 2
+
+        # Registers taken from documentation, held as plain integers with
+        # the current key split into its left and right halves
+        left   = int.from_bytes(ipek[:8], 'big')
+        right  = int.from_bytes(ipek[8:], 'big')
+        ksnr   = ksn[ksn_offset:]
         r3     = self.copy_counter(ksnr)
-        r8     = self.reset_counter(ksnr.bytes)
-        sr     = BitArray(hex='0x100000')
-       
-        while (sr.bytes[0] != '\x00') or (sr.bytes[1] != '\x00') or (sr.bytes[2] != '\x00'):
-            tmp = self.copy_counter(sr)
-            tmp = tmp & r3
-            if (tmp.bytes[0] != '\x00') or (tmp.bytes[1] != '\x00') or (tmp.bytes[2] != '\x00'): 
-                # Step 2
-                n_ctr = BitArray(bytes=r8.bytes[ctr_offset:]) | sr
-                r8    = BitArray(bytes=r8.bytes[:ctr_offset]+n_ctr.bytes)
-                
-                # Step 3
-                r8a   = r8 ^ BitArray(bytes=curkey.bytes[right_offset:])
-                
-                # Step 4
-                cipher = DES.new(curkey.bytes[:DES.key_size], DES.MODE_ECB)
-                r8a    = BitArray(bytes=cipher.encrypt(r8a.bytes))
-                
-                # Step 5
-                r8a = BitArray(bytes=curkey.bytes[right_offset:]) ^ r8a
-
-                # Step 6
-                curkey = curkey ^ c_mask
-                
-                # Step 7
-                r8b = BitArray(bytes=curkey.bytes[right_offset:]) ^ r8
-                
-                # Step 8
-                cipher = DES.new(curkey.bytes[:DES.key_size], DES.MODE_ECB)
-                r8b    = BitArray(bytes=cipher.encrypt(r8b.bytes))
-                
-                # Step 9
-                r8b = BitArray(bytes=curkey.bytes[right_offset:]) ^ r8b
-
-                # Step 10 / 11
-                curkey = BitArray(bytes=r8b.bytes+r8a.bytes)
-
-            sr >>= 1
-        self._cur_key = curkey
-        return curkey
+        r8     = int.from_bytes(self.reset_counter(ksnr), 'big')
+
+        # Walk only the set counter bits, most significant first
+        while r3:
+            sr  = 1 << (r3.bit_length() - 1)
+            r3 ^= sr
+
+            # Step 2
+            r8 |= sr
+
+            if cache is not None:
+                state = cache.get((ipek, r8))
+                if state is not None:
+                    left, right = state
+                    continue
+
+            # Step 3
+            r8a = r8 ^ right
+
+            # Step 4
+            cipher = _des_cipher(left.to_bytes(8, 'big'), cache)
+            r8a    = int.from_bytes(cipher.encrypt(r8a.to_bytes(8, 'big')), 'big')
+
+            # Step 5
+            r8a ^= right
+
+            # Step 6
+            left  ^= _C_MASK8
+            right ^= _C_MASK8
+
+            # Step 7
+            r8b = r8 ^ right
+
+            # Step 8
+            cipher = _des_cipher(left.to_bytes(8, 'big'), cache)
+            r8b    = int.from_bytes(cipher.encrypt(r8b.to_bytes(8, 'big')), 'big')
+
+            # Step 9
+            r8b ^= right
+
+            # Step 10 / 11
+            left, right = r8b, r8a
+
+            if cache is not None:
+                cache[ipek, r8] = (left, right)
+
+        self._cur_key = left.to_bytes(8, 'big') + right.to_bytes(8, 'big')
+        return self._cur_key
 
     def reset_counter(self, data):
         """Reset the counter to zero
 
         Keyword arguments:
-        data (raw or BitArray) -- Must be at least 3 bytes
+        data (raw) -- Must be at least 3 bytes
         
         Return:
-        BitArray of the data passed in
+        bytes of the data passed in
         """
-        if isinstance(data, BitArray):
-            data = data.bytes
         if len(data) < 3:
             return None
-        mask = BitArray(hex='0xe00000')
-        ctr  = BitArray(bytes=data[len(data)-3:])
-        return BitArray(bytes=data[:-3] + (mask & ctr).bytes)
+        return data[:-3] + bytes([data[-3] & 0xE0, 0, 0])
 
     def copy_counter(self, data):
-        """Copy only the counter bytes from a given string or BitArray
+        """Copy only the counter bits from a given string
 
         Keyword arguments:
-        data (raw or BitArray) -- Must be at least 3 bytes
+        data (raw) -- Must be at least 3 bytes
 
         Return:
-        BitArray of only the counter bytes
+        int of only the counter bits
         """
-        mask = BitArray(hex='0x1fffff')
-        if len(data.bytes) > 3:
-            ctr = BitArray(bytes=data.bytes[-3:])
-        else:
-            ctr = data
-
-        return mask & ctr
+        return int.from_bytes(data[-3:], 'big') & _CTR_MASK
 
     def increase_counter(self):
         """Increase the counter bytes of the stored ksn by one"""
-        ctr = self._ksn.cut(21, start=59).next().int + 1
-        self._ksn.overwrite('0b'+BitArray(int=ctr, length=21).bin, 59)
+        ksn  = self._ksn
+        tail = int.from_bytes(ksn[-3:], 'big')
+        tail = (tail & ~_CTR_MASK) | ((tail + 1) & _CTR_MASK)
+        self._ksn = ksn[:-3] + tail.to_bytes(3, 'big')
+
+    def counters(self, n):
+        """List the next n KSNs from the stored ksn without advancing it
+
+        Keyword arguments:
+        n (int) -- Number of KSNs, starting with the stored ksn
+
+        Return:
+        list of ksn in bytes
+        """
+        prefix = self._ksn[:-3]
+        tail   = int.from_bytes(self._ksn[-3:], 'big')
+        top    = tail & ~_CTR_MASK
+        return [prefix + (top | ((tail + i) & _CTR_MASK)).to_bytes(3, 'big')
+                for i in range(n)]
 
 class Server(DUKPT):
     def __init__(self, bdk=None):
@@ -146,10 +185,16 @@ class Server(DUKPT):
             self.bdk = self.generate_bdk()
             DUKPT.__init__(self, bdk=self.bdk)
 
+        # The IPEK ciphers depend only on the BDK, build them once
+        tdes_key           = self._bdk + self._bdk[:DES.key_size]
+        variant            = int.from_bytes(tdes_key, 'big') ^ _C_MASK24
+        self._cipher_left  = DES3.new(tdes_key, DES3.MODE_ECB)
+        self._cipher_right = DES3.new(variant.to_bytes(24, 'big'), DES3.MODE_ECB)
+
     def generate_ksn(self):
         """Genereate a new random KSN with counter bits zeroed
         Return:
-        BitArray of the new KSN
+        bytes of the new KSN
         """
         return self.reset_counter(get_random_bytes(self.KSN_LEN))
     def generate_bdk(self):
@@ -163,14 +208,12 @@ class Server(DUKPT):
         """Generate a new IPEK based on the given KSN
 
         Keyword arguments:
-        ksn (raw or BitArray) -- Key Serial Number
+        ksn (raw) -- Key Serial Number
 
         Return:
-        BitArray of the new IPEK
+        bytes of the new IPEK
         """
-        if isinstance(ksn, str):
-            ksn = BitArray(bytes=ksn)
-        self._tdes_key = self._bdk.bytes + self._bdk.bytes[:DES.key_size]
+        ksn = self.reset_counter(ksn)
         self.generate_left_ipek(ksn)
         self.generate_right_ipek(ksn)
         return self._ipek
@@ -179,43 +222,75 @@ class Server(DUKPT):
         """Generate the left portion of the IPEK (8 bytes)
 
         Keyword arguments:
-        ksn (raw or BitArray) -- Key Serial Number)
+        ksn (raw) -- Key Serial Number with counter bits zeroed
         """
-        ksn        = self.reset_counter(ksn.bytes)
-        cipher     = DES3.new(self._tdes_key, DES3.MODE_ECB)
-        self._ipek = BitArray(bytes=cipher.encrypt(ksn.bytes[:8]))
+        self._ipek = self._cipher_left.encrypt(ksn[:8])
 
     def generate_right_ipek(self, ksn):
         """Generate the right portion of the IPEK (8 bytes)
 
         Keyword arguments:
-        ksn (raw or BitArray) -- Key Serial Number
+        ksn (raw) -- Key Serial Number with counter bits zeroed
         """
-        mask       = BitArray(hex="0xc0c0c0c000000000c0c0c0c000000000c0c0c0c000000000")
-        key        = mask ^ BitArray(bytes=self._tdes_key)
-        cipher     = DES3.new(key.bytes, DES3.MODE_ECB)
-        self._ipek = BitArray(bytes=self._ipek.bytes + cipher.encrypt(ksn.bytes[:8]))
+        self._ipek = self._ipek + self._cipher_right.encrypt(ksn[:8])
 
     def gen_key(self, ksn):
         """Generate the next key given the KSN
         
         Keyword arguments:
-        ksn (raw or BitArray) -- Key Serial Number (10 bytes)
+        ksn (raw) -- Key Serial Number (10 bytes)
         
         Return:
         key in bytes
         """
         ipek = self.generate_ipek(ksn)
-        key  = self.derive_key(ipek, BitArray(bytes=ksn))
-        return key.bytes
+        return self.derive_key(ipek, ksn)
+
+    def gen_keys(self, ksns):
+        """Generate the keys for a batch of KSNs
+
+        KSNs from the same device share an IPEK, so it is only generated
+        once per device, and the IPEK halves of every device in the batch
+        are encrypted with a single ECB call per half. Without the
+        _dukpt_core extension, keys whose counters share leading bits
+        also share the intermediate keys derived for those bits.
+
+        Keyword arguments:
+        ksns (iterable of raw) -- Key Serial Numbers (10 bytes each)
+
+        Return:
+        list of keys in bytes
+        """
+        ksns = [bytes(ksn) for ksn in ksns]
+        for ksn in ksns:
+            if len(ksn) != self.KSN_LEN:
+                raise InvalidDUKPTArguments("KSN must have a length of %d" % self.KSN_LEN)
+        devices = [self.reset_counter(ksn) for ksn in ksns]
+        unique  = list(dict.fromkeys(devices))
+        blocks  = b''.join(device[:8] for device in unique)
+        left    = self._cipher_left.encrypt(blocks)
+        right   = self._cipher_right.encrypt(blocks)
+        ipeks   = {}
+        for i, device in enumerate(unique):
+            half = slice(i * 8, i * 8 + 8)
+            ipeks[device] = left[half] + right[half]
+
+        if _derive_keys is not None:
+            keys = _derive_keys(b''.join(ipeks[device] for device in devices),
+                                b''.join(ksns))
+            return [keys[i:i + 16] for i in range(0, len(keys), 16)]
+
+        cache = {}
+        return [self.derive_key(ipeks[device], ksn, cache)
+                for device, ksn in zip(devices, ksns)]
 
 class Client(DUKPT):
     def __init__(self, ipek, ksn):
         """Initialization of client
         
         Keyword arguments:
-        ipek (raw or BitArray) -- Initial Pin Encryption Key
-        ksn  (raw or BitArray) -- Key Serial Number
+        ipek (raw) -- Initial Pin Encryption Key
+        ksn  (raw) -- Key Serial Number
         """
         DUKPT.__init__(self, ipek=ipek, ksn=ksn)
         self.increase_counter()
@@ -227,6 +302,31 @@ class Client(DUKPT):
         key in bytes
         """
         key = self.derive_key(self._ipek, self._ksn)
-        info = {'ksn': self._ksn.bytes, 'key': key.bytes}
+        info = {'ksn': self._ksn, 'key': key}
         self.increase_counter()
         return info
+
+    def gen_keys(self, n):
+        """Generate the next n keys in the sequence
+
+        Keyword arguments:
+        n (int) -- Number of keys to generate
+
+        Return:
+        tuple of (list of ksn in bytes, list of key in bytes), where the
+        key at each index belongs to the ksn at the same index
+        """
+        if n < 0:
+            raise InvalidDUKPTArguments("Number of keys must not be negative")
+        ksns      = self.counters(n + 1)
+        self._ksn = ksns.pop()
+
+        if _derive_keys is not None:
+            keys = _derive_keys(self._ipek * n, b''.join(ksns))
+            keys = [keys[i:i + 16] for i in range(0, len(keys), 16)]
+        else:
+            cache = {}
+            keys  = [self.derive_key(self._ipek, ksn, cache) for ksn in ksns]
+        if keys:
+            self._cur_key = keys[-1]
+        return ksns, keys
@@ -1,9 +1,25 @@
-from distutils.core import setup
+from distutils.core import setup, Extension
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    # Without Cython only the pure Python implementation is installed
+    ext_modules = []
+else:
+    ext_modules = cythonize([
+        Extension('_dukpt_core', ['_dukpt_core.pyx'], libraries=['crypto'],
+                  define_macros=[('OPENSSL_SUPPRESS_DEPRECATED', None)]),
+    ])
+    # A failed C build still installs the pure Python module. Set after
+    # cythonize, which does not carry optional over to its extensions.
+    for ext in ext_modules:
+        ext.optional = True
 
 setup(
     name = 'dukpt',
     version = '1.0.0',
     py_modules = ['dukpt'],
+    ext_modules = ext_modules,
     long_description = open('README.md').read(),
     install_requires = open('requirements.txt').readlines(),
 )
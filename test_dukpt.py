@@ -0,0 +1,94 @@
+import os
+import unittest
+from binascii import unhexlify
+
+import dukpt
+
+# ANSI X9.24 test vector
+BDK  = unhexlify('0123456789ABCDEFFEDCBA9876543210')
+KSN  = unhexlify('FFFF9876543210E00000')
+IPEK = unhexlify('6AC292FAA1315B4D858AB3A3D7D5933A')
+
+# KSN -> derived key, from the X9.24 vectors and an independent
+# implementation of the spec for counters of 0x10000 and up
+KEYS = {
+    'FFFF9876543210E00001': '042666B49184CFA368DE9628D0397BC9',
+    'FFFF9876543210E00002': 'C46551CEF9FD24B0AA9AD834130D3BC7',
+    'FFFF9876543210E00003': '0DF3D9422ACA56E547676D07AD6BADFA',
+    'FFFF9876543210E10000': '2F9A0C0B46ECCB5EF8287A7A071AF5B4',
+    'FFFF9876543210F5A5A5': '3DC2F8075D50E7CBBBC1B08D3B30D040',
+    'FFFF9876543210FFFFFF': '9D3A9BED76215A4F2137EA76BC0D6176',
+}
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = dukpt.Server(BDK)
+
+    def test_generate_ipek(self):
+        self.assertEqual(self.server.generate_ipek(KSN), IPEK)
+
+    def test_generate_ipek_ignores_counter(self):
+        for ksn in KEYS:
+            self.assertEqual(self.server.generate_ipek(unhexlify(ksn)), IPEK)
+
+    def test_gen_key(self):
+        for ksn, key in KEYS.items():
+            self.assertEqual(self.server.gen_key(unhexlify(ksn)), unhexlify(key))
+
+    def test_gen_keys(self):
+        ksns = [unhexlify(ksn) for ksn in KEYS] + [os.urandom(10) for _ in range(50)]
+        self.assertEqual(self.server.gen_keys(ksns),
+                         [self.server.gen_key(ksn) for ksn in ksns])
+
+    def test_gen_keys_bytearray(self):
+        ksn = unhexlify('FFFF9876543210E10000')
+        self.assertEqual(self.server.gen_keys([bytearray(ksn)]),
+                         [self.server.gen_key(bytearray(ksn))])
+
+    def test_gen_keys_ksn_length(self):
+        # 9 + 11 bytes must not pass as two 10 byte KSNs
+        with self.assertRaises(dukpt.InvalidDUKPTArguments):
+            self.server.gen_keys([KSN[:9], KSN + b'\x00'])
+
+class ClientTest(unittest.TestCase):
+    def test_gen_key(self):
+        client = dukpt.Client(IPEK, KSN)
+        for ksn in list(KEYS)[:3]:
+            info = client.gen_key()
+            self.assertEqual(info, {'ksn': unhexlify(ksn), 'key': unhexlify(KEYS[ksn])})
+
+    def test_gen_keys(self):
+        a = dukpt.Client(IPEK, KSN)
+        b = dukpt.Client(IPEK, KSN)
+        infos = [a.gen_key() for _ in range(40)]
+        ksns, keys = b.gen_keys(40)
+        self.assertEqual(ksns, [info['ksn'] for info in infos])
+        self.assertEqual(keys, [info['key'] for info in infos])
+        self.assertEqual(a.gen_key(), b.gen_key())
+
+    def test_gen_keys_negative(self):
+        client = dukpt.Client(IPEK, KSN)
+        with self.assertRaises(dukpt.InvalidDUKPTArguments):
+            client.gen_keys(-1)
+        self.assertEqual(client.gen_keys(0), ([], []))
+
+@unittest.skipIf(dukpt._derive_key is None, '_dukpt_core extension not built')
+class CoreTest(unittest.TestCase):
+    def setUp(self):
+        self.derive_key  = dukpt._derive_key
+        self.derive_keys = dukpt._derive_keys
+
+    def tearDown(self):
+        dukpt._derive_key  = self.derive_key
+        dukpt._derive_keys = self.derive_keys
+
+    def test_matches_python(self):
+        server = dukpt.Server(BDK)
+        ksns   = [unhexlify(ksn) for ksn in KEYS] + [os.urandom(10) for _ in range(200)]
+        core   = server.gen_keys(ksns)
+        dukpt._derive_key = dukpt._derive_keys = None
+        self.assertEqual(core, server.gen_keys(ksns))
+        self.assertEqual(core, [server.gen_key(ksn) for ksn in ksns])
+
+if __name__ == '__main__':
+    unittest.main()